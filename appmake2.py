@@ -1,9 +1,7 @@
 import streamlit as st
 import ee
-import geemap.foliumap as geemap
 import pandas as pd
-import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 
 # ---------------------
 # PAGE CONFIG
@@ -44,6 +42,23 @@ st.write(f"**Coordinates:** Latitude = {lat}, Longitude = {lon}")
 # ---------------------
 start_date = st.date_input("Start Date", value=pd.to_datetime("2024-01-01"))
 end_date = st.date_input("End Date", value=pd.to_datetime("2024-01-31"))
+accurate_composite = st.checkbox(
+    "Accurate composite",
+    value=False,
+    help="Render the NDVI map from a median composite instead of a mosaic. Slower to load."
+)
+# Default NDVI sampling scale; a quarter of the pixels of native 10 m
+NDVI_SCALE_DEFAULT = 20
+# Minimum NDVI sampling radius; widened to the scale so the buffer covers a pixel
+NDVI_BUFFER_M = 30
+
+ndvi_scale = st.select_slider(
+    "NDVI sampling scale (m)",
+    options=[10, 20, 30, 60],
+    value=NDVI_SCALE_DEFAULT,
+    help="Coarser scales read fewer Sentinel-2 pixels and return faster; "
+         "10 m is native resolution."
+)
 
 # ---------------------
 # SESSION STATE FOR BUTTON
@@ -54,34 +69,163 @@ if "analyze_clicked" not in st.session_state:
 def on_analyze_click():
     st.session_state.analyze_clicked = True
 
-st.button("Analyze Location", on_click=on_analyze_click)
+# Filled at the end of the script so the button can be disabled while
+# Earth Engine is busy and repeat clicks cannot queue duplicate queries
+analyze_button = st.empty()
 
 # ---------------------
-# ANALYSIS FUNCTION
+# MAP STYLE
 # ---------------------
-def analyze_location(lat, lon, start_date, end_date):
-    point = ee.Geometry.Point([lon, lat])
+NDVI_VIS = {"min": 0.0, "max": 1.0, "palette": ["red", "yellow", "green"]}
+
+LEGEND_HTML = """
+<div style="position: fixed; 
+            bottom: 50px; left: 50px; width: 200px; height: 160px; 
+            border:2px solid grey; z-index:9999; font-size:14px;
+            background-color:white; padding: 10px;">
+<b>Legend</b><br>
+<i class="fa fa-map-marker" style="color:green"></i> Healthy<br>
+<i class="fa fa-map-marker" style="color:orange"></i> Moderate<br>
+<i class="fa fa-map-marker" style="color:red"></i> Non-Healthy<br>
+<i class="fa fa-map-marker" style="color:gray"></i> No Data
+</div>
+"""
+
+# ---------------------
+# EARTH ENGINE QUERIES
+# ---------------------
+SOIL_LABELS = {
+    "oc": "Organic Carbon (g/kg)",
+    "ph": "Soil pH (H2O)",
+    "sand": "Sand Fraction (%)",
+    "clay": "Clay Fraction (%)",
+}
+
+# (asset id, surface band) for each soil property in SOIL_LABELS
+SOIL_ASSETS = {
+    "oc": ("OpenLandMap/SOL/SOL_ORGANIC-CARBON_USDA-6A1C_M/v02", "ocd_usda.6a1c_m_sl1_250m"),
+    "ph": ("OpenLandMap/SOL/SOL_PH-H2O_USDA-4C1A2A_M/v02", "phh2o_usda.4c1a2a_m_sl1_250m"),
+    "sand": ("OpenLandMap/SOL/SOL_SAND-Content_USDA-3A1A1A_M/v02", "sand_usda.3a1a1a_m_sl1_250m"),
+    "clay": ("OpenLandMap/SOL/SOL_CLAY-Content_USDA-3A1A1A_M/v02", "clay_usda.3a1a1a_m_sl1_250m"),
+}
+
+def select_soil_band(asset, band):
+    # A missing band falls back server-side to a fully masked image, which
+    # reduces to null ("No Data") instead of failing the whole request.
+    img = ee.Image(asset)
+    return ee.Image(ee.Algorithms.If(
+        img.bandNames().contains(band),
+        img.select(band),
+        ee.Image().rename(band)
+    ))
+
+# Shared Earth Engine handles are built once per process, not on every rerun.
+@st.cache_resource(show_spinner=False)
+def get_mean_reducer():
+    return ee.Reducer.mean()
+
+@st.cache_resource(show_spinner=False)
+def get_soil_images():
+    return {key: select_soil_band(asset, band) for key, (asset, band) in SOIL_ASSETS.items()}
+
+# Geometries are pure functions of the coordinates. Streamlit re-executes this
+# script on every rerun, so cache_resource (not functools.lru_cache) keeps them.
+@st.cache_resource(max_entries=128, show_spinner=False)
+def get_point(lat, lon):
+    return ee.Geometry.Point([lon, lat])
+
+def build_ndvi_collection(lat, lon, start_date, end_date):
+    point = get_point(lat, lon)
 
-    # NDVI CALCULATION
     s2 = (ee.ImageCollection("COPERNICUS/S2_SR")
           .filterBounds(point)
           .filterDate(str(start_date), str(end_date))
           .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", 10)))
 
     def add_ndvi(img):
+        # Mask cloud shadow (3), cloud (8, 9) and cirrus (10) pixels using the scene
+        # classification band, which every S2_SR scene carries
+        scl = img.select("SCL")
+        clear = scl.neq(3).And(scl.neq(8)).And(scl.neq(9)).And(scl.neq(10))
+        img = img.updateMask(clear)
         ndvi = img.normalizedDifference(["B8", "B4"]).rename("NDVI")
         return img.addBands(ndvi)
 
-    ndvi_img = s2.map(add_ndvi).median().select("NDVI")
+    return s2.map(add_ndvi).select("NDVI")
 
-    try:
-        mean_ndvi = ndvi_img.reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=point.buffer(30),
-            scale=10
-        ).get("NDVI").getInfo()
-    except Exception:
-        mean_ndvi = None
+# Cached per (location, date range, scale) so repeated clicks skip Earth Engine entirely.
+# Only plain values are returned; ee.Image objects are rebuilt by the caller.
+# The statistic always uses the median composite; only the map layer may mosaic.
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def compute_ndvi_and_soil(lat, lon, start_date, end_date, ndvi_scale=NDVI_SCALE_DEFAULT):
+    point = get_point(lat, lon)
+    ndvi_aoi = point.buffer(max(NDVI_BUFFER_M, ndvi_scale))
+    soil_aoi = point.buffer(250)
+
+    # NDVI CALCULATION
+    ndvi_img = build_ndvi_collection(lat, lon, start_date, end_date).median()
+
+    # An empty collection yields a band-less composite; check server-side
+    ndvi_stats = ee.Dictionary(ee.Algorithms.If(
+        ndvi_img.bandNames().contains("NDVI"),
+        ndvi_img.reduceRegion(
+            reducer=get_mean_reducer(),
+            geometry=ndvi_aoi,
+            scale=ndvi_scale
+        ),
+        ee.Dictionary({})
+    ))
+
+    # SOIL INFORMATION
+    soil_images = get_soil_images()
+
+    # Stack all soil layers so they are reduced in a single request
+    soil_stack = ee.Image.cat(list(soil_images.values())).rename(list(soil_images.keys()))
+    soil_stats = soil_stack.reduceRegion(
+        reducer=get_mean_reducer(),
+        geometry=soil_aoi,
+        scale=250
+    )
+
+    # One server-side dictionary, one round trip for every value on the page.
+    # Trade-off: a failure on either side (e.g. a median over a long date range
+    # running out of memory) blanks NDVI and soil together for that run.
+    # Errors propagate so st.cache_data never stores a failed lookup.
+    vals = ee.Dictionary(soil_stats).combine(ndvi_stats).getInfo()
+
+    result = {"mean_ndvi": vals.get("NDVI")}
+    for key in SOIL_LABELS:
+        result[key] = vals.get(key)
+    return result
+
+# Tile URLs are cached instead of the ee.Image, so reruns rebuild a static map
+# without another getMapId() round trip. Map ids expire, hence the shorter TTL.
+@st.cache_data(ttl=60 * 60, show_spinner=False)
+def get_ndvi_tile_url(lat, lon, start_date, end_date, accurate_composite):
+    # The map is only a display layer: a mosaic loads much faster than a median
+    ndvi_collection = build_ndvi_collection(lat, lon, start_date, end_date)
+    ndvi_img = ndvi_collection.median() if accurate_composite else ndvi_collection.mosaic()
+    # Errors propagate so st.cache_data never stores a failed lookup
+    map_id = ndvi_img.getMapId(NDVI_VIS)
+    return map_id["tile_fetcher"].url_format
+
+# ---------------------
+# ANALYSIS FUNCTION
+# ---------------------
+def analyze_location(lat, lon, start_date, end_date, accurate_composite=False, ndvi_scale=NDVI_SCALE_DEFAULT):
+    with st.spinner("Contacting Earth Engine..."):
+        try:
+            values = compute_ndvi_and_soil(lat, lon, start_date, end_date, ndvi_scale)
+        except Exception:
+            # Not cached, so the next run retries Earth Engine
+            st.warning("Earth Engine request failed; NDVI and soil values are unavailable. Please try again.")
+            values = dict.fromkeys(["mean_ndvi", *SOIL_LABELS])
+        try:
+            tile_url = get_ndvi_tile_url(lat, lon, start_date, end_date, accurate_composite)
+        except Exception:
+            st.warning("Earth Engine could not render the NDVI layer; showing the map without it.")
+            tile_url = None
+    mean_ndvi = values["mean_ndvi"]
 
     if mean_ndvi is None:
         status = "No Data"
@@ -102,65 +246,33 @@ def analyze_location(lat, lon, start_date, end_date):
 
     # SOIL INFORMATION
     soil_info = {}
-    def get_soil_value(img, band_name, buffer=250, scale=250):
-        try:
-            bands = img.bandNames().getInfo()
-            if band_name not in bands:
-                return None
-            val = img.reduceRegion(
-                reducer=ee.Reducer.mean(),
-                geometry=point.buffer(buffer),
-                scale=scale
-            ).get(band_name).getInfo()
-            return val
-        except Exception:
-            return None
-
-    soil_oc = ee.Image("OpenLandMap/SOL/SOL_ORGANIC-CARBON_USDA-6A1C_M/v02")
-    soil_oc_band = "ocd_usda.6a1c_m_sl1_250m"
-    oc_val = get_soil_value(soil_oc, soil_oc_band)
-    soil_info["Organic Carbon (g/kg)"] = f"{oc_val:.2f}" if oc_val is not None else "No Data"
-
-    soil_ph = ee.Image("OpenLandMap/SOL/SOL_PH-H2O_USDA-4C1A2A_M/v02")
-    soil_ph_band = "phh2o_usda.4c1a2a_m_sl1_250m"
-    ph_val = get_soil_value(soil_ph, soil_ph_band)
-    soil_info["Soil pH (H2O)"] = f"{ph_val:.2f}" if ph_val is not None else "No Data"
-
-    soil_sand = ee.Image("OpenLandMap/SOL/SOL_SAND-Content_USDA-3A1A1A_M/v02")
-    soil_sand_band = "sand_usda.3a1a1a_m_sl1_250m"
-    sand_val = get_soil_value(soil_sand, soil_sand_band)
-    soil_info["Sand Fraction (%)"] = f"{sand_val:.2f}" if sand_val is not None else "No Data"
-
-    soil_clay = ee.Image("OpenLandMap/SOL/SOL_CLAY-Content_USDA-3A1A1A_M/v02")
-    soil_clay_band = "clay_usda.3a1a1a_m_sl1_250m"
-    clay_val = get_soil_value(soil_clay, soil_clay_band)
-    soil_info["Clay Fraction (%)"] = f"{clay_val:.2f}" if clay_val is not None else "No Data"
+    for key, label in SOIL_LABELS.items():
+        val = values[key]
+        soil_info[label] = f"{val:.2f}" if val is not None else "No Data"
 
     # MAP VISUALIZATION
-    m = geemap.Map(center=[lat, lon], zoom=12)
-    ndvi_vis = {"min": 0.0, "max": 1.0, "palette": ["red", "yellow", "green"]}
-    m.add_layer(ndvi_img, ndvi_vis, "NDVI Background")
+    # folium is imported only once an analysis is requested
+    import folium
+
+    m = folium.Map(location=[lat, lon], zoom_start=12)
+    if tile_url is not None:
+        folium.TileLayer(
+            tiles=tile_url,
+            attr="Google Earth Engine",
+            name="NDVI Background",
+            overlay=True
+        ).add_to(m)
 
-    popup_text = f"NDVI: {ndvi_str}\nStatus: {status}\n"
-    for k, v in soil_info.items():
-        popup_text += f"{k}: {v}\n"
+    popup_text = "\n".join([
+        f"NDVI: {ndvi_str}",
+        f"Status: {status}",
+        *[f"{k}: {v}" for k, v in soil_info.items()],
+    ])
 
     folium.Marker(location=[lat, lon], popup=popup_text, icon=folium.Icon(color=color)).add_to(m)
 
     # Legend
-    legend_html = """
-    <div style="position: fixed; 
-                bottom: 50px; left: 50px; width: 200px; height: 160px; 
-                border:2px solid grey; z-index:9999; font-size:14px;
-                background-color:white; padding: 10px;">
-    <b>Legend</b><br>
-    <i class="fa fa-map-marker" style="color:green"></i> Healthy<br>
-    <i class="fa fa-map-marker" style="color:orange"></i> Moderate<br>
-    <i class="fa fa-map-marker" style="color:red"></i> Non-Healthy<br>
-    <i class="fa fa-map-marker" style="color:gray"></i> No Data
-    </div>
-    """
-    m.get_root().html.add_child(folium.Element(legend_html))
+    m.get_root().html.add_child(folium.Element(LEGEND_HTML))
 
     # RESULTS DISPLAY
     st.subheader("📊 Results")
@@ -168,10 +280,15 @@ def analyze_location(lat, lon, start_date, end_date):
     st.write(f"**NDVI:** {ndvi_str} → **{status} vegetation**")
     st.write("### 🌍 Soil Properties")
     st.json(soil_info)
-    st_folium(m, width="100%", height=600)
+    components.html(m.get_root().render(), height=600)
 
 # ---------------------
 # RUN ANALYSIS ONLY IF BUTTON CLICKED
 # ---------------------
-if st.session_state.analyze_clicked:
-    analyze_location(lat, lon, start_date, end_date)
+try:
+    if st.session_state.analyze_clicked:
+        analyze_button.button("Analyze Location", disabled=True, key="analyze_busy")
+        analyze_location(lat, lon, start_date, end_date, accurate_composite, ndvi_scale)
+finally:
+    # Always restore the live button, even if the analysis raised
+    analyze_button.button("Analyze Location", on_click=on_analyze_click, key="analyze")